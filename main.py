@@ -1,24 +1,30 @@
 import os
 import sqlite3
 import logging
-import json
+import re
 import random
+import asyncio
+import threading
 import time
+import hashlib
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional
 from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
 
 from fastapi import FastAPI, Query, HTTPException, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-import requests
-from bs4 import BeautifulSoup
-from fake_useragent import UserAgent
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
+import aiohttp
+import orjson
+from cachetools import LRUCache, TLRUCache
+import lxml.html
+from lxml import etree
+from selectolax.lexbor import LexborHTMLParser
 
 # --- Конфігурація ---
 logging.basicConfig(level=logging.INFO)
@@ -26,45 +32,219 @@ logger = logging.getLogger(__name__)
 
 DB_NAME = "amazon_data.db"
 templates = Jinja2Templates(directory="templates")
-ua = UserAgent()
+# Статичний набір сучасних десктопних User-Agent (без завантаження бази fake_useragent)
+_UAS = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36 Edg/121.0.0.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:122.0) Gecko/20100101 Firefox/122.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 OPR/106.0.0.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Safari/605.1.15",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.3 Safari/605.1.15",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 14.2; rv:121.0) Gecko/20100101 Firefox/121.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 14.3; rv:122.0) Gecko/20100101 Firefox/122.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36 Edg/121.0.0.0",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0",
+    "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:122.0) Gecko/20100101 Firefox/122.0",
+)
+
+MAX_RETRIES = 3
+MAX_RETRY_AFTER = 30  # секунд; довше чекати всередині запиту до API не варто
+MAX_CONNECTIONS_PER_HOST = 10  # не перевантажуємо Amazon
+MAX_DETAIL_WORKERS = 8
+SCRAPE_QUEUE_SIZE = 200
+WRITE_BATCH_SIZE = 50
+DETAILS_TTL = 6 * 3600  # булети та Prime змінюються рідко
+CATEGORY_PAGE_MAX_BYTES = 512 * 1024  # сітка бестселерів - на початку сторінки
+KEEPALIVE_TIMEOUT = 60  # секунд тримаємо TCP+TLS з'єднання з Amazon між запитами
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=15)
+
+try:
+    import brotli  # noqa: F401 - aiohttp розпаковує br, лише якщо встановлено brotli
+    ACCEPT_ENCODING = 'br, gzip, deflate'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+_host_semaphores: Dict[str, asyncio.Semaphore] = {}
+# Кеш деталей товару по ASIN (той самий товар буває в кількох категоріях)
+# Значення - (details, fetched_at); термін життя рахується від fetched_at, а не від моменту вставки
+_details_cache = TLRUCache(maxsize=2048, ttu=lambda _asin, entry, _now: entry[1] + DETAILS_TTL, timer=time.time)
+
+_ASIN_RE = re.compile(r'"asin"\s*:\s*"([A-Z0-9]{10})"')
+# Швидкі екстрактори по сирих байтах товару (без обходу DOM)
+_ITEM_ID_RE = re.compile(rb'id="(p13n-asin-index-\d+)"')
+_DIV_TAG_RE = re.compile(rb'<(/?)div[\s>]')
+_RANK_RE = re.compile(rb'class="zg-bdg-text"[^>]*>#(\d+)<')
+_RATING_RE = re.compile(rb'(\d\.\d)\s+out of 5 stars')
+
+# XPath компілюються один раз при завантаженні модуля
+_GRID_ITEMS_XP = etree.XPath('//div[starts-with(@id, "p13n-asin-index")]')
+_FACEOUT_ITEMS_XP = etree.XPath('//*[contains(concat(" ", normalize-space(@class), " "), " zg-grid-general-faceout ")]')
 
 # --- База даних ---
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS products (
+# Одне з'єднання на весь застосунок (app.state.db), доступ з різних потоків - під локом
+_db_lock = threading.Lock()
+
+def get_conn() -> sqlite3.Connection:
+    """Підключення до БД: WAL (вмикається в init_db) + менше fsync на кожен commit."""
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-65536')  # 64 MB
+    return conn
+
+PRODUCTS_SCHEMA = '''CREATE TABLE IF NOT EXISTS products (
         asin TEXT PRIMARY KEY,
         title TEXT,
         rank INTEGER,
         price TEXT,
-        rating TEXT,
+        rating REAL,
         reviews_count TEXT,
         is_prime BOOLEAN,
         bullet_points TEXT,
         image_url TEXT,
         category_url TEXT,
-        updated_at TIMESTAMP
-    )''')
+        updated_at TIMESTAMP DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+    )'''
+
+# UPSERT оновлює рядок на місці (без DELETE + INSERT) і лише якщо дані змінились
+_INSERT_PRODUCT_SQL = '''INSERT INTO products
+    (asin, title, rank, price, rating, reviews_count, is_prime, bullet_points, image_url, category_url)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(asin) DO UPDATE SET
+        title = excluded.title, rank = excluded.rank, price = excluded.price, rating = excluded.rating,
+        reviews_count = excluded.reviews_count, is_prime = excluded.is_prime,
+        bullet_points = excluded.bullet_points, image_url = excluded.image_url,
+        category_url = excluded.category_url, updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+    WHERE products.rank IS NOT excluded.rank OR products.price IS NOT excluded.price
+        OR products.rating IS NOT excluded.rating OR products.reviews_count IS NOT excluded.reviews_count
+        OR products.title IS NOT excluded.title OR products.is_prime IS NOT excluded.is_prime
+        OR products.bullet_points IS NOT excluded.bullet_points OR products.image_url IS NOT excluded.image_url
+        OR products.category_url IS NOT excluded.category_url'''
+
+_INSERT_CATEGORY_SQL = '''INSERT INTO categories (url, name, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT(url) DO UPDATE SET name = excluded.name, updated_at = excluded.updated_at
+    WHERE categories.name IS NOT excluded.name'''
+
+def init_db(conn: sqlite3.Connection):
+    # WAL зберігається у файлі БД, тому достатньо ввімкнути один раз
+    conn.execute('PRAGMA journal_mode=WAL')
+    c = conn.cursor()
+    c.execute(PRODUCTS_SCHEMA)
+    # Старі БД зберігали rating текстом ("4.5 out of 5 stars") і не мали DEFAULT для updated_at -
+    # перебудовуємо таблицю за актуальною схемою
+    columns = {row[1]: (row[2], row[4]) for row in c.execute("PRAGMA table_info(products)")}
+    if columns['rating'][0] != 'REAL' or columns['updated_at'][1] is None:
+        # Вся міграція - одна транзакція, щоб збій не лишив products_old поруч з порожньою products
+        c.execute('BEGIN')
+        try:
+            c.execute('ALTER TABLE products RENAME TO products_old')
+            c.execute(PRODUCTS_SCHEMA)
+            c.execute('''INSERT INTO products SELECT asin, title, rank, price,
+                CASE WHEN rating GLOB '[0-9]*' THEN CAST(rating AS REAL) END,
+                reviews_count, is_prime, bullet_points, image_url, category_url,
+                CASE WHEN updated_at LIKE '%Z' THEN updated_at
+                     ELSE strftime('%Y-%m-%dT%H:%M:%fZ', updated_at, 'utc') END
+                FROM products_old''')
+            c.execute('DROP TABLE products_old')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_rank ON products(rank)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_rating ON products(rating)')
     c.execute('''CREATE TABLE IF NOT EXISTS categories (
         url TEXT PRIMARY KEY,
         name TEXT,
         updated_at TIMESTAMP
     )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS details_cache (
+        asin TEXT PRIMARY KEY,
+        bullets TEXT,
+        is_prime BOOLEAN,
+        fetched_at REAL
+    )''')
     conn.commit()
-    conn.close()
+
+# Лише колонки, які показує фронтенд
+CATEGORY_COLUMNS = ("url", "name")
+PRODUCT_COLUMNS = ("asin", "title", "rank", "price", "rating", "reviews_count",
+                   "is_prime", "bullet_points", "image_url")
+
+def load_categories(conn: sqlite3.Connection) -> List[dict]:
+    with _db_lock:
+        rows = conn.execute(f"SELECT {', '.join(CATEGORY_COLUMNS)} FROM categories").fetchall()
+    return [dict(zip(CATEGORY_COLUMNS, row)) for row in rows]
+
+def load_products(conn: sqlite3.Connection, min_rating: Optional[float], limit: int) -> List[dict]:
+    query = f"SELECT {', '.join(PRODUCT_COLUMNS)} FROM products"
+    params = []
+    if min_rating is not None:
+        query += " WHERE rating >= ?"
+        params.append(min_rating)
+    query += " ORDER BY rank ASC LIMIT ?"
+    params.append(limit)
+
+    with _db_lock:
+        rows = conn.execute(query, params).fetchall()
+    return [dict(zip(PRODUCT_COLUMNS, row)) for row in rows]
+
+def save_products(conn: sqlite3.Connection, items: List[dict]):
+    with _db_lock, conn:  # одна транзакція на весь пакет
+        conn.executemany(_INSERT_PRODUCT_SQL,
+        [(i['asin'], i['title'], i['rank'], i['price'], i['rating'], i['reviews_count'], i['is_prime'], i['bullet_points'], i['image_url'], i['category_url']) for i in items])
+
+async def product_writer(conn: sqlite3.Connection, queue: asyncio.Queue):
+    """Єдиний споживач черги: пише товари пачками по WRITE_BATCH_SIZE, None - кінець потоку."""
+    batch = []
+    while (product := await queue.get()) is not None:
+        batch.append(product)
+        if len(batch) >= WRITE_BATCH_SIZE:
+            await asyncio.to_thread(save_products, conn, batch)
+            batch = []
+    if batch:
+        await asyncio.to_thread(save_products, conn, batch)
+
+def load_cached_details(conn: sqlite3.Connection, asin: str) -> Optional[tuple]:
+    """Повертає (details, fetched_at) для ще не простроченого запису."""
+    with _db_lock:
+        row = conn.execute("SELECT bullets, is_prime, fetched_at FROM details_cache WHERE asin = ? AND fetched_at >= ?",
+                           (asin, time.time() - DETAILS_TTL)).fetchone()
+    return ({"bullets": row[0], "is_prime": bool(row[1])}, row[2]) if row else None
+
+def save_cached_details(conn: sqlite3.Connection, asin: str, details: dict, fetched_at: float):
+    with _db_lock, conn:
+        conn.execute("INSERT OR REPLACE INTO details_cache (asin, bullets, is_prime, fetched_at) VALUES (?, ?, ?, ?)",
+                     (asin, details['bullets'], details['is_prime'], fetched_at))
+        # Прострочені записи більше не потрібні - не даємо таблиці рости безмежно
+        conn.execute("DELETE FROM details_cache WHERE fetched_at < ?", (fetched_at - DETAILS_TTL,))
+
+def save_categories(conn: sqlite3.Connection, rows: List[tuple]):
+    with _db_lock, conn:
+        conn.executemany(_INSERT_CATEGORY_SQL, rows)
 
 # --- Допоміжні функції ---
+_BASE_HEADERS = {
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Encoding': ACCEPT_ENCODING,
+    'Referer': 'https://www.amazon.com/',
+    'DNT': '1',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+}
+
 def get_headers():
     """Генерація заголовків для імітації браузера."""
-    return {
-        'User-Agent': ua.random,
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Referer': 'https://www.amazon.com/',
-        'DNT': '1',
-        'Connection': 'keep-alive',
-        'Upgrade-Insecure-Requests': '1',
-    }
+    return {**_BASE_HEADERS, 'User-Agent': random.choice(_UAS)}
 
 def clean_text(text: Optional[str]) -> str:
     """Очищення тексту від зайвих пробілів."""
@@ -72,176 +252,364 @@ def clean_text(text: Optional[str]) -> str:
         return ""
     return text.strip()
 
+def parse_rating(text: Optional[str]) -> Optional[float]:
+    """"4.5 out of 5 stars" -> 4.5"""
+    try:
+        return float(clean_text(text).split()[0])
+    except (IndexError, ValueError):
+        return None
+
+def targeted_fragment(body: bytes, *markers: bytes) -> Optional[bytes]:
+    """
+    Відрізає сторінку до першого тегу з одним із маркерів,
+    щоб парсер не будував дерево для шапки, скриптів і меню.
+    """
+    positions = [pos for pos in (body.find(marker) for marker in markers) if pos != -1]
+    if not positions:
+        return None
+    start = body.rfind(b'<', 0, min(positions))
+    return body[max(start, 0):]
+
+def _item_end(body: bytes, start: int, limit: int) -> Optional[int]:
+    """Позиція після закриваючого </div> контейнера товару, що починається в start."""
+    depth = 0
+    for tag in _DIV_TAG_RE.finditer(body, start, limit):
+        depth += -1 if tag.group(1) else 1
+        if depth == 0:
+            return tag.end()
+    return None
+
+def split_item_chunks(body: bytes) -> Dict[str, bytes]:
+    """
+    Нарізає сторінку на шматки сирих байтів по товарах: id контейнера -> байти до його </div>.
+    Якщо контейнер не закрито (сторінку обрізано), шматок порожній - тоді працює DOM-fallback.
+    """
+    starts = list(_ITEM_ID_RE.finditer(body))
+    limits = [match.start() for match in starts[1:]] + [len(body)]
+    chunks = {}
+    for match, limit in zip(starts, limits):
+        start = body.rfind(b'<div', 0, match.start())
+        end = _item_end(body, start, limit) if start != -1 else None
+        chunks[match.group(1).decode()] = body[start:end] if end else b''
+    return chunks
+
+def find_grid_items(tree: LexborHTMLParser):
+    """Надійні селектори для сітки товарів."""
+    return tree.css('div[id^="p13n-asin-index"]') or tree.css('.zg-grid-general-faceout')
+
+def find_grid_items_lxml(body: bytes):
+    """
+    Fallback для битої верстки: толерантний lxml шукає сітку готовими XPath,
+    а в lexbor передаються лише знайдені товари, а не вся сторінка.
+    """
+    root = lxml.html.fromstring(body)
+    elements = _GRID_ITEMS_XP(root) or _FACEOUT_ITEMS_XP(root)
+    if not elements:
+        return []
+    return find_grid_items(LexborHTMLParser(b''.join(lxml.html.tostring(el) for el in elements)))
+
 # --- Логіка парсингу з Retry (повторними спробами) ---
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2), retry=retry_if_exception_type(requests.RequestException))
-def fetch_url(url: str):
-    """Виконує запит з автоматичними повторами при помилках."""
-    time.sleep(random.uniform(1.5, 3.5)) # Затримка, щоб не бути заблокованим
-    response = requests.get(url, headers=get_headers(), timeout=15)
-    
-    if response.status_code == 503:
-        raise requests.RequestException("Amazon 503 Service Unavailable")
-        
-    # Перевірка на капчу Amazon
-    if "api-services-support@amazon.com" in response.text:
-        raise requests.RequestException("Amazon Captcha Block")
-        
-    response.raise_for_status()
-    return response
+def create_http_session() -> aiohttp.ClientSession:
+    """
+    Одна сесія на застосунок: keep-alive пул з'єднань (без нового TLS-рукостискання
+    на кожен товар) і кеш DNS.
+    """
+    connector = aiohttp.TCPConnector(
+        limit_per_host=MAX_CONNECTIONS_PER_HOST,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=300,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+class FetchError(Exception):
+    """Amazon заблокував запит (503 / капча)."""
+
+def _host_semaphore(url: str) -> asyncio.Semaphore:
+    """Семафор на хост, щоб обмежити кількість одночасних запитів."""
+    host = urlsplit(url).netloc
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = _host_semaphores[host] = asyncio.Semaphore(MAX_CONNECTIONS_PER_HOST)
+    return semaphore
+
+def _retry_after(response: aiohttp.ClientResponse) -> float:
+    """Читає заголовок Retry-After (у секундах), якщо Amazon його надіслав."""
+    value = response.headers.get('Retry-After', '')
+    return float(value) if value.isdigit() else 0.0
+
+async def read_body(response: aiohttp.ClientResponse, max_bytes: Optional[int] = None) -> bytes:
+    """
+    Читає тіло відповіді потоком, зупиняючись після max_bytes.
+    Обрізане читання лишає відповідь недочитаною, і aiohttp закриває сокет замість повернення
+    в keep-alive пул. Тому обрізаємо лише тоді, коли тіло точно більше за ліміт або його розмір невідомий.
+    """
+    if max_bytes is None or (response.content_length is not None and response.content_length <= max_bytes):
+        return await response.read()
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        body += chunk
+        if len(body) >= max_bytes:
+            break
+    return bytes(body[:max_bytes])
+
+async def fetch_url(session: aiohttp.ClientSession, url: str, max_bytes: Optional[int] = None) -> bytes:
+    """Виконує запит з експоненційними повторами при помилках."""
+    for attempt in range(MAX_RETRIES):
+        delay = 2 ** attempt + random.random()
+        try:
+            async with _host_semaphore(url):
+                await asyncio.sleep(random.uniform(1.5, 3.5)) # Затримка, щоб не бути заблокованим
+                async with session.get(url, headers=get_headers(), timeout=REQUEST_TIMEOUT) as response:
+                    if response.status in (429, 503):
+                        delay = max(delay, min(_retry_after(response), MAX_RETRY_AFTER))
+                        raise FetchError(f"Amazon {response.status} Service Unavailable")
+                    response.raise_for_status()
+                    body = await read_body(response, max_bytes)
+
+            # Перевірка на капчу Amazon
+            if b"api-services-support@amazon.com" in body:
+                raise FetchError("Amazon Captcha Block")
+            return body
+        except (aiohttp.ClientError, asyncio.TimeoutError, FetchError) as e:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            logger.warning(f"Retrying {url} in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
 
-def get_product_details(product_url: str):
+async def fetch_product_details(session: aiohttp.ClientSession, product_url: str) -> Optional[dict]:
     """
     Глибокий парсинг: заходимо всередину товару за булетами та Prime.
+    Повертає None, якщо сторінка не схожа на сторінку товару (заглушка, капча, інша верстка).
     """
-    try:
-        if not product_url.startswith("http"):
-            product_url = "https://www.amazon.com" + product_url
-            
-        response = fetch_url(product_url)
-        soup = BeautifulSoup(response.content, 'lxml')
+    if not product_url.startswith("http"):
+        product_url = "https://www.amazon.com" + product_url
         
-        # 1. Bullet Points
-        bullets = []
-        # Пробуємо різні варіанти верстки
-        bullet_div = soup.select_one('#feature-bullets') or soup.select_one('#av-feature-bullets')
-        if bullet_div:
-            items = bullet_div.select('li span.a-list-item')
-            bullets = [clean_text(item.get_text()) for item in items[:5]]
+    body = await fetch_url(session, product_url)
+    fragment = targeted_fragment(body, b'id="prime-header-link"', b'id="feature-bullets"',
+                                 b'id="av-feature-bullets"', b'a-icon-prime')
+    if fragment is None:
+        # Звичайна сторінка товару без Prime і булетів (книги, медіа) - валідний результат
+        if b'id="productTitle"' in body or b'id="dp"' in body:
+            return {"bullets": "", "is_prime": False}
+        return None
+    tree = LexborHTMLParser(fragment)
+    
+    # 1. Bullet Points
+    bullets = []
+    # Пробуємо різні варіанти верстки
+    bullet_div = tree.css_first('#feature-bullets') or tree.css_first('#av-feature-bullets')
+    if bullet_div:
+        items = bullet_div.css('li span.a-list-item')
+        bullets = [clean_text(item.text()) for item in items[:5]]
+    
+    # 2. Prime Status
+    is_prime = False
+    if tree.css_first('#prime-header-link') or tree.css_first('i.a-icon-prime'):
+        is_prime = True
         
-        # 2. Prime Status
-        is_prime = False
-        if soup.select_one('#prime-header-link') or soup.select_one('i.a-icon-prime'):
-            is_prime = True
-            
-        return {"bullets": "\n".join(bullets), "is_prime": is_prime}
+    return {"bullets": "\n".join(bullets), "is_prime": is_prime}
+
+async def get_product_details(session: aiohttp.ClientSession, conn: sqlite3.Connection, product_url: str, asin: str):
+    """Деталі товару з кешем по ASIN: пам'ять -> таблиця details_cache -> Amazon."""
+    cacheable = asin != "N/A"
+    if cacheable:
+        entry = _details_cache.get(asin) or await asyncio.to_thread(load_cached_details, conn, asin)
+        if entry:
+            _details_cache[asin] = entry  # зберігає початковий fetched_at, тож TTL не подовжується
+            return entry[0]
+
+    try:
+        details = await fetch_product_details(session, product_url)
     except Exception as e:
         logger.warning(f"Could not fetch details for {product_url}: {e}")
         return {"bullets": "", "is_prime": False}
 
-def scrape_amazon_category(url: str, limit: int = 5):
+    if details is None:
+        # Нерозпізнана сторінка - не кешуємо порожній результат на 6 годин
+        logger.warning(f"Unrecognised product page layout: {product_url}")
+        return {"bullets": "", "is_prime": False}
+
+    if cacheable:
+        fetched_at = time.time()
+        _details_cache[asin] = (details, fetched_at)
+        await asyncio.to_thread(save_cached_details, conn, asin, details, fetched_at)
+    return details
+
+async def scrape_amazon_category(session: aiohttp.ClientSession, conn: sqlite3.Connection, url: str, limit: int = 5):
+    """Асинхронний генератор: віддає товари по одному, щойно для них завершився deep scrape."""
     logger.info(f"Scraping category: {url}")
     try:
-        response = fetch_url(url)
-        soup = BeautifulSoup(response.content, 'lxml')
-        
-        # Надійні селектори для сітки товарів
-        items = soup.select('div[id^="p13n-asin-index"]')
+        body = await fetch_url(session, url, max_bytes=CATEGORY_PAGE_MAX_BYTES)
+        fragment = targeted_fragment(body, b'id="p13n-asin-index', b'zg-grid-general-faceout') or body
+        items = find_grid_items(LexborHTMLParser(fragment))
         if not items:
-             items = soup.select('.zg-grid-general-faceout')
+            # lexbor не знайшов сітку - пробуємо толерантніший lxml
+            items = find_grid_items_lxml(body)
+        chunks = split_item_chunks(body)
 
-        parsed_items = []
+        staged = []
         for item in items[:limit]:
             try:
                 # 1. ASIN
                 asin = "N/A"
-                item_json = item.get('data-p13n-asin-metadata')
+                item_json = item.attributes.get('data-p13n-asin-metadata')
                 if item_json:
-                    asin = json.loads(item_json)['asin']
+                    match = _ASIN_RE.search(item_json)
+                    asin = match.group(1) if match else "N/A"
                 
                 # 2. Title (Спроба кількох селекторів)
-                title_el = (item.select_one('div[class*="p13n-sc-css-line-clamp"]') or 
-                            item.select_one('div.p13n-sc-truncated') or
-                            item.select_one('a.a-link-normal span div'))
-                title = clean_text(title_el.get_text()) if title_el else "Unknown Title"
-
-                # 3. Rank
-                rank_el = item.select_one('.zg-bdg-text')
-                rank = int(rank_el.get_text().replace('#', '')) if rank_el else 0
+                title_el = (item.css_first('div[class*="p13n-sc-css-line-clamp"]') or 
+                            item.css_first('div.p13n-sc-truncated') or
+                            item.css_first('a.a-link-normal span div'))
+                title = clean_text(title_el.text()) if title_el else "Unknown Title"
+
+                # 3. Rank (regex по байтах товару, DOM - якщо regex не спрацював)
+                raw = chunks.get(item.attributes.get('id'), b'')
+                rank_match = _RANK_RE.search(raw)
+                if rank_match:
+                    rank = int(rank_match.group(1))
+                else:
+                    rank_el = item.css_first('.zg-bdg-text')
+                    rank = int(clean_text(rank_el.text()).replace('#', '')) if rank_el else 0
                 
                 # 4. Price
-                price_el = (item.select_one('span.a-color-price') or 
-                            item.select_one('span.p13n-sc-price') or
-                            item.select_one('span._cDEzb_p13n-sc-price_3mJ9Z'))
-                price = clean_text(price_el.get_text()) if price_el else "N/A"
+                price_el = (item.css_first('span.a-color-price') or 
+                            item.css_first('span.p13n-sc-price') or
+                            item.css_first('span._cDEzb_p13n-sc-price_3mJ9Z'))
+                price = clean_text(price_el.text()) if price_el else "N/A"
 
                 # 5. Rating & Reviews
-                rating_el = item.select_one('i.a-icon-star-small span')
-                rating = clean_text(rating_el.get_text()) if rating_el else "N/A"
+                rating_match = _RATING_RE.search(raw)
+                if rating_match:
+                    rating = float(rating_match.group(1))
+                else:
+                    rating_el = item.css_first('i.a-icon-star-small span')
+                    rating = parse_rating(rating_el.text()) if rating_el else None
                 
-                reviews_el = item.select_one('span.a-size-small')
-                reviews = clean_text(reviews_el.get_text()) if reviews_el else "0"
+                reviews_el = item.css_first('span.a-size-small')
+                reviews = clean_text(reviews_el.text()) if reviews_el else "0"
                 
                 # 6. Image
-                img_el = item.select_one('img.a-dynamic-image')
-                image_url = img_el.get('src') if img_el else ""
-                
-                # 7. Deep Scrape (Заходимо на сторінку)
-                link_el = item.select_one('a.a-link-normal')
-                detail_data = {"bullets": "", "is_prime": False}
+                img_el = item.css_first('img.a-dynamic-image')
+                image_url = img_el.attributes.get('src') if img_el else ""
                 
-                if link_el and link_el.get('href'):
-                    detail_data = get_product_details(link_el.get('href'))
+                # 7. Посилання для Deep Scrape
+                link_el = item.css_first('a.a-link-normal')
+                href = link_el.attributes.get('href') if link_el else None
                 
-                product_data = {
+                staged.append(({
                     "asin": asin,
                     "title": title,
                     "rank": rank,
                     "price": price,
                     "rating": rating,
                     "reviews_count": reviews,
-                    "is_prime": detail_data['is_prime'],
-                    "bullet_points": detail_data['bullets'],
                     "image_url": image_url,
                     "category_url": url,
-                    "updated_at": datetime.now()
-                }
-                parsed_items.append(product_data)
+                }, href))
                 
             except Exception as e:
                 logger.error(f"Error parsing specific item: {e}")
                 continue
-                
-        return parsed_items
 
     except Exception as e:
         logger.error(f"Scraping fatal error: {e}")
-        return []
+        return
+
+    # Deep Scrape: заходимо на сторінки товарів паралельно
+    workers = asyncio.Semaphore(min(MAX_DETAIL_WORKERS, limit))
 
-def scrape_root_categories():
+    async def with_details(product_data: dict, href: Optional[str]):
+        detail_data = {"bullets": "", "is_prime": False}
+        if href:
+            async with workers:
+                detail_data = await get_product_details(session, conn, href, product_data['asin'])
+        product_data["is_prime"] = detail_data['is_prime']
+        product_data["bullet_points"] = detail_data['bullets']
+        return product_data
+
+    tasks = [asyncio.create_task(with_details(product_data, href)) for product_data, href in staged]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def scrape_root_categories(session: aiohttp.ClientSession, conn: sqlite3.Connection):
     """Оновлення категорій з fallback-селекторами."""
     url = "https://www.amazon.com/gp/bestsellers"
     logger.info("Updating root categories...")
     try:
-        response = fetch_url(url)
-        soup = BeautifulSoup(response.content, 'lxml')
+        body = await fetch_url(session, url)
+        tree = LexborHTMLParser(targeted_fragment(body, b'role="group"', b'id="zg_browseRoot"') or body)
         
         # Спроба знайти бічне меню
-        cat_links = soup.select('div[role="group"] div[role="treeitem"] a')
+        cat_links = tree.css('div[role="group"] div[role="treeitem"] a')
         if not cat_links:
-            cat_links = soup.select('ul#zg_browseRoot a')
+            cat_links = tree.css('ul#zg_browseRoot a')
             
         categories = []
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        
+        rows = []
+        now = datetime.now()
         for link in cat_links:
-            href = link.get('href')
-            name = clean_text(link.get_text())
+            href = link.attributes.get('href')
+            name = clean_text(link.text())
             if href and name:
                 full_url = f"https://www.amazon.com{href}"
-                c.execute("INSERT OR REPLACE INTO categories (url, name, updated_at) VALUES (?, ?, ?)",
-                          (full_url, name, datetime.now()))
+                rows.append((full_url, name, now))
                 categories.append({"name": name, "url": full_url})
         
-        conn.commit()
-        conn.close()
+        await asyncio.to_thread(save_categories, conn, rows)
+        invalidate_cache("categories")
         return categories
     except Exception as e:
         logger.error(f"Failed to update categories: {e}")
         return []
 
+# --- Кеш відповідей API ---
+# (endpoint, параметри) -> (etag, готові JSON-байти); скидається після запису в БД
+_response_cache = LRUCache(maxsize=256)
+_cache_generation = {"categories": 0, "products": 0}
+
+def invalidate_cache(endpoint: str):
+    _cache_generation[endpoint] += 1
+    for key in [key for key in _response_cache if key[0] == endpoint]:
+        _response_cache.pop(key, None)
+
+async def cached_json(request: Request, key: tuple, load, *args) -> Response:
+    """Віддає закешовані JSON-байти з ETag; 304, якщо у клієнта та сама версія."""
+    entry = _response_cache.get(key)
+    if entry is None:
+        generation = _cache_generation[key[0]]
+        body = orjson.dumps(await asyncio.to_thread(load, *args))
+        entry = (f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"', body)
+        # Не кешуємо, якщо дані змінились, поки ми читали БД
+        if generation == _cache_generation[key[0]]:
+            _response_cache[key] = entry
+
+    etag, body = entry
+    if_none_match = request.headers.get('if-none-match', '')
+    if if_none_match == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return Response(status_code=304, headers={'ETag': etag})
+    return Response(content=body, media_type='application/json', headers={'ETag': etag})
+
 # --- FastAPI App ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    init_db()
+    app.state.db = get_conn()
+    init_db(app.state.db)
+    app.state.http = create_http_session()
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(scrape_root_categories, 'interval', hours=24)
+    scheduler.add_job(scrape_root_categories, 'interval', hours=24, args=[app.state.http, app.state.db])
     scheduler.start()
     yield
     scheduler.shutdown()
+    await app.state.http.close()
+    app.state.db.close()
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -255,29 +623,35 @@ async def read_root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 @app.get("/api/categories")
-def get_categories():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM categories")
-    rows = c.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+async def get_categories(request: Request):
+    return await cached_json(request, ("categories",), load_categories, request.app.state.db)
+
+@app.get("/api/products")
+async def get_products(request: Request, min_rating: Optional[float] = Query(None), limit: int = Query(100, ge=1, le=1000)):
+    return await cached_json(request, ("products", min_rating, limit), load_products,
+                             request.app.state.db, min_rating, limit)
 
 @app.post("/api/scrape")
-def trigger_scrape(url: str = Query(...)):
-    items = scrape_amazon_category(url)
+async def trigger_scrape(request: Request, url: str = Query(...)):
+    queue = asyncio.Queue(maxsize=SCRAPE_QUEUE_SIZE)
+    writer = asyncio.create_task(product_writer(request.app.state.db, queue))
+
+    items = []
+    try:
+        async for product in scrape_amazon_category(request.app.state.http, request.app.state.db, url):
+            items.append(product)
+            await queue.put(product)
+    finally:
+        # Навіть якщо скрейп впав або запит скасовано - дописуємо вже зібране і зупиняємо writer
+        try:
+            if not writer.done():
+                await queue.put(None)
+            await writer
+        finally:
+            invalidate_cache("products")
+
     if not items:
         return {"status": "error", "message": "Amazon blocked requests or changed layout.", "data": []}
-        
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    for i in items:
-        c.execute('''INSERT OR REPLACE INTO products 
-        (asin, title, rank, price, rating, reviews_count, is_prime, bullet_points, image_url, category_url, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', 
-        (i['asin'], i['title'], i['rank'], i['price'], i['rating'], i['reviews_count'], i['is_prime'], i['bullet_points'], i['image_url'], i['category_url'], i['updated_at']))
-    conn.commit()
-    conn.close()
     
+    items.sort(key=lambda p: p['rank'])
     return {"status": "success", "count": len(items), "data": items}
\ No newline at end of file